@@ -1,17 +1,48 @@
 #!/usr/bin/env python3
 import asyncio
-import json
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
+import re
 import sys
+import time
 import base64
-from typing import Optional, Dict, Any, List
+import importlib.util
+from collections import OrderedDict, defaultdict, deque
+from typing import Optional, Dict, Any, List, Deque, Tuple, Union, Callable
 from io import BytesIO
+import numpy as np
 from PIL import Image
+import orjson
+from pydantic import BaseModel, ValidationError
 
+import httpx
+import openai
 from dotenv import load_dotenv
-from livekit.agents import AutoSubscribe, JobContext, Agent, AgentSession
-from livekit.rtc import Track, TrackKind, VideoStream
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional; the frame signature falls back to NumPy
+    njit = None
+
+try:
+    import uvloop
+except ImportError:  # uvloop is optional; fall back to the default asyncio loop
+    uvloop = None
+
+if sys.version_info < (3, 11, 0):
+    import taskgroup
+
+    asyncio.TaskGroup = taskgroup.TaskGroup
+
+try:
+    from xxhash import xxh3_64_intdigest as _image_key
+except ImportError:  # xxhash is optional; the builtin bytes hash is good enough for a cache key
+    _image_key = hash
+from livekit.agents import AutoSubscribe, JobContext, Agent, AgentSession, APIError
+from livekit.rtc import Track, TrackKind, VideoStream, VideoFrame, VideoBufferType
 from livekit.agents import llm, tts
 from livekit.plugins.openai import tts as openai_tts
 # Import the OpenAI LLM plugin correctly
@@ -28,9 +59,45 @@ LIVEKIT_URL: str = os.getenv("LIVEKIT_URL", "wss://elemento-u3zedxjs.livekit.clo
 LIVEKIT_API_KEY: Optional[str] = os.getenv("LIVEKIT_API_KEY")
 LIVEKIT_API_SECRET: Optional[str] = os.getenv("LIVEKIT_API_SECRET")
 
+# One pooled HTTP client shared by the LLM and TTS so connections (and their
+# TLS handshakes) are reused across calls. HTTP/2 needs the optional h2 package.
+# Timeouts match the livekit OpenAI plugin; retries are left to the plugin's
+# conn_options, so the SDK client itself does not retry.
+OPENAI_HTTP2 = importlib.util.find_spec("h2") is not None
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = 32
+OPENAI_MAX_CONNECTIONS = 64
+OPENAI_KEEPALIVE_EXPIRY = 120.0  # seconds
+OPENAI_TIMEOUT = httpx.Timeout(connect=15.0, read=5.0, write=5.0, pool=5.0)
+
 SPEAKING_FRAME_RATE = 1.0
 NOT_SPEAKING_FRAME_RATE = 0.5
 
+# Adaptive video quality: degrade frame rate / resolution when the pipeline
+# p95 latency exceeds the target, recover when it is comfortably below it.
+TARGET_LATENCY = 3.0  # seconds, summed p95 across stages
+MAX_FRAME_RATE_DIVISOR = 4
+FRAME_RESOLUTIONS: List[Tuple[int, int]] = [(1280, 720), (960, 540), (640, 360)]
+
+# Images sent to the vision LLM are downscaled and re-encoded as JPEG
+MAX_IMAGE_SIDE = 1024
+JPEG_QUALITY = 75
+IMAGE_CACHE_SIZE = 4  # encoded canvas images kept for repeat analyses
+
+# Speculative analysis: once the canvas has been visually stable for a while,
+# analyze it ahead of time so the reply is ready when the student asks.
+STABILITY_CHECK_INTERVAL = 0.4  # seconds between frame hashes
+STABLE_FRAME_COUNT = 3  # identical successive hashes (~800ms) before speculating
+SPECULATIVE_PROMPT = "Please analyze what you see on my canvas."
+# Requests the speculative reply answers as-is; other questions get it as context instead
+_GENERIC_CHECK_RE = re.compile(
+    r"^(?:(?:can|could|would) you |please )*"
+    r"(?:(?:check|look at|review|analy[sz]e|what do you think of) (?:my|this|the) (?:work|canvas|answer|solution|board)"
+    r"|is (?:this|it|my (?:work|answer|solution)) (?:right|correct|ok|okay)"
+    r"|how am i doing|what do you think)"
+    r"(?: so far)?(?: please)?\W*$",
+    re.IGNORECASE,
+)
+
 # System prompt for the math tutor
 _SYSTEM_PROMPT = """
 You are an educational AI tutor specializing in Math and Physics. You analyze the student's work displayed on the whiteboard/notepad and provide both feedback on their current work and hints to help them move ahead with the given question.
@@ -50,6 +117,104 @@ If the student provides no work or asks a question directly:
 - Respond with a friendly, encouraging message that motivates the student to try the problem.
 """
 
+# Standing reference appended to the system prompt. Besides guiding the tutor,
+# it takes the prompt past the 1024-token minimum for OpenAI prompt caching.
+_TUTORING_REFERENCE = """
+Reference guidelines for reviewing student work:
+
+Reading the canvas:
+- The canvas is a freehand whiteboard. Handwriting may be messy; when a symbol is ambiguous (for example 1 and 7, x and a multiplication sign, 5 and s, a minus sign and a fraction bar), choose the reading that makes the student's work consistent and mention the ambiguity only if it changes the answer.
+- Work is usually written top to bottom and left to right. Crossed-out work has been abandoned by the student and should be ignored unless it contains the correct idea they later dropped.
+- Diagrams, arrows and free-body sketches are part of the work. Check that labels, directions and magnitudes on diagrams agree with the equations written next to them.
+- If the canvas is empty or unreadable, say so kindly and invite the student to write the question or their first step.
+
+Checking mathematics:
+- Arithmetic: re-do every numeric step yourself, including signs, order of operations, distribution across brackets, and carrying of negative signs through fractions.
+- Algebra: confirm that each line follows from the previous one by a valid operation applied to both sides. Watch for dividing by an expression that may be zero, squaring both sides without checking for extraneous roots, and cancelling terms rather than factors.
+- Functions and calculus: verify derivative and integral rules (chain rule, product rule, constants of integration, limits of integration after substitution) and the domain of any logarithm, root or inverse trigonometric function.
+- Geometry and trigonometry: check that angles are in the unit the student intends (degrees or radians), that the correct ratio is used for the given sides, and that the diagram matches the stated lengths.
+- Final answers: check that the answer addresses what was asked, is simplified sensibly, and has a plausible size and sign.
+
+Checking physics:
+- Units: every quantity should carry units, equations should be dimensionally consistent, and conversions (for example km/h to m/s, grams to kilograms, minutes to seconds) must be applied before substituting.
+- Formulas: confirm the formula applies to the situation (constant acceleration, uniform fields, ideal gases, small angles) and that each symbol is substituted with the right quantity.
+- Vectors: check directions, sign conventions and components. A consistent choice of positive direction matters more than which direction was chosen.
+- Forces and energy: check that all forces on the free-body diagram are included exactly once, that Newton's third law pairs are not placed on the same body, and that energy bookkeeping includes every form that changes.
+- Significant figures: answers should use a sensible number of significant figures given the data, but do not treat this as the first mistake unless it is the only one.
+
+Giving feedback:
+- Point to the exact line or step where the first mistake happens, say what is wrong in one short sentence, and ask a guiding question rather than giving the corrected line.
+- Praise something specific that the student did well before or after the correction.
+- Never give the complete final answer unless the student has already reached it themselves; then confirm it and congratulate them.
+- Keep the whole reply short enough to be spoken aloud in about fifteen seconds. Avoid markdown, tables, bullet lists and LaTeX, since the reply is read out by text-to-speech; say formulas in words, for example "v equals u plus a t".
+- Use plain, encouraging language suitable for a high school or early university student, and avoid jargon that the student has not used themselves.
+
+Hints when the student is stuck:
+- Start from what the question gives and what it asks for, and suggest the single next step or the relevant principle, not a full plan.
+- If the student has asked the same thing more than once, make the next hint slightly more specific than the previous one.
+- Encourage the student to check their own work, for example by substituting the answer back into the original equation or by estimating the expected order of magnitude.
+"""
+
+# Pinned once so every request starts with the identical prefix, which lets
+# server-side prefix caching (OpenAI / vLLM) reuse it across calls.
+_SYSTEM_MESSAGE = llm.ChatMessage(role="system", content=[_SYSTEM_PROMPT + _TUTORING_REFERENCE])
+
+# Expected failures handled in place; anything else reaches an outer handler
+_LLM_ERRORS = (APIError, openai.APIError, asyncio.TimeoutError)
+_IMAGE_ERRORS = (OSError, ValueError)  # PIL decode/encode, base64 and frame conversion errors
+
+_ANALYSIS_FALLBACK_TEXT = "I'm having trouble analyzing your work. Please try again."
+
+# ---------------------------------------------------------------------------
+# Data packets & RPC payloads
+# ---------------------------------------------------------------------------
+
+
+class AnalyzeImageRequest(BaseModel):
+    """Payload of the ``analyzeImage`` RPC."""
+
+    imageData: str
+    prompt: Optional[str] = None
+
+
+class AnalyzeImageResponse(BaseModel):
+    """Reply to the ``analyzeImage`` RPC; unset fields are left out of the JSON."""
+
+    status: Optional[str] = None
+    message: Optional[str] = None
+    error: Optional[str] = None
+
+    def to_json(self) -> str:
+        return self.model_dump_json(exclude_none=True)
+
+
+class TranscriptionMsg(BaseModel):
+    """Student speech packet received on the ``transcription`` topic."""
+
+    text: str
+
+
+# Envelopes that never change are encoded once
+_AGENT_METADATA = orjson.dumps({"kind": "agent"}).decode()
+_NO_IMAGE_RESPONSE = AnalyzeImageResponse(error="No image data provided").to_json()
+_IMAGE_SUCCESS_RESPONSE = AnalyzeImageResponse(status="success", message="Image analysis complete").to_json()
+
+# Analysis requests arriving within the batch window are answered by a single LLM call
+ANALYSIS_BATCH_SIZE = 8
+ANALYSIS_BATCH_TIMEOUT = 0.05  # seconds
+_ANSWER_DELIMITER = "\n---\n"
+MAX_HISTORY_MESSAGES = 20  # earlier user/assistant messages kept after the system message
+
+# Streaming replies: the publish queue is bounded for backpressure, and tokens
+# are grouped before publishing so the data channel is not flooded with tiny
+# packets. The TTS queue is unbounded: say() only starts reading it once
+# earlier speech has finished, and a reply is at most a few hundred tokens.
+STREAM_QUEUE_SIZE = 100
+STREAM_PUBLISH_CHUNK_CHARS = 20
+
+# Text messages published within this window are sent as one data packet
+PUBLISH_FLUSH_DELAY = 0.015  # seconds
+
 # ---------------------------------------------------------------------------
 # Logging
 # ---------------------------------------------------------------------------
@@ -58,7 +223,203 @@ logger = logging.getLogger("math-tutor-agent")
 logger.setLevel(logging.INFO)
 handler = logging.StreamHandler(sys.stdout)
 handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
-logger.addHandler(handler)
+
+# Records are handed to a listener thread so writing to stdout never blocks the event loop
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_listener = logging.handlers.QueueListener(_log_queue, handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+# Select the uvloop policy at import time so job processes spawned by the worker use it too
+if uvloop is not None:
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+logger.info("Using event loop policy: %s", type(asyncio.get_event_loop_policy()).__name__)
+
+# ---------------------------------------------------------------------------
+# OpenAI client
+# ---------------------------------------------------------------------------
+
+
+def _create_openai_client() -> openai.AsyncOpenAI:
+    """Create an OpenAI client with a pooled HTTP connection, owned by one job.
+
+    Clients are bound to the event loop they are first used on, so jobs running
+    as threads in one process must not share one.
+    """
+    http_client = httpx.AsyncClient(
+        http2=OPENAI_HTTP2,
+        limits=httpx.Limits(
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+        ),
+        timeout=OPENAI_TIMEOUT,
+    )
+    return openai.AsyncOpenAI(http_client=http_client, max_retries=0)
+
+
+# ---------------------------------------------------------------------------
+# Frame signature
+# ---------------------------------------------------------------------------
+
+_SIGNATURE_GRID = 8  # 8x8 blocks -> 64-bit signature
+
+
+def _frame_signature_numpy(rgb: np.ndarray, blocks: np.ndarray) -> np.uint64:
+    """Average hash of an RGB frame: 8x8 block means thresholded at their mean, packed into 64 bits.
+
+    ``blocks`` is a preallocated (8, 8) float64 buffer that receives the block means.
+    """
+    height = rgb.shape[0] // _SIGNATURE_GRID * _SIGNATURE_GRID
+    width = rgb.shape[1] // _SIGNATURE_GRID * _SIGNATURE_GRID
+    cells = rgb[:height, :width].reshape(
+        _SIGNATURE_GRID, height // _SIGNATURE_GRID, _SIGNATURE_GRID, width // _SIGNATURE_GRID, 3
+    )
+    np.mean(cells, axis=(1, 3, 4), out=blocks)
+    return np.uint64(int.from_bytes(np.packbits(blocks > blocks.mean()).tobytes(), "big"))
+
+
+def _frame_signature_kernel(rgb: np.ndarray, blocks: np.ndarray) -> np.uint64:
+    """Loop form of ``_frame_signature_numpy`` for Numba to compile."""
+    cell_height = rgb.shape[0] // _SIGNATURE_GRID
+    cell_width = rgb.shape[1] // _SIGNATURE_GRID
+    for cell in range(_SIGNATURE_GRID * _SIGNATURE_GRID):
+        row = cell // _SIGNATURE_GRID
+        col = cell % _SIGNATURE_GRID
+        total = 0.0
+        for y in range(row * cell_height, (row + 1) * cell_height):
+            for x in range(col * cell_width, (col + 1) * cell_width):
+                total += float(rgb[y, x, 0]) + float(rgb[y, x, 1]) + float(rgb[y, x, 2])
+        blocks[row, col] = total / (cell_height * cell_width * 3)
+
+    mean = blocks.mean()
+    signature = np.uint64(0)
+    for i in range(_SIGNATURE_GRID * _SIGNATURE_GRID):
+        if blocks[i // _SIGNATURE_GRID, i % _SIGNATURE_GRID] > mean:
+            signature |= np.uint64(1) << np.uint64(63 - i)
+    return signature
+
+
+if njit is not None:
+    _frame_signature = njit(cache=True, fastmath=True, nogil=True)(_frame_signature_kernel)
+else:
+    _frame_signature = _frame_signature_numpy
+
+# ---------------------------------------------------------------------------
+# Adaptive quality
+# ---------------------------------------------------------------------------
+
+
+class LatencyOptimizer:
+    """Track per-stage latency and degrade video quality when the pipeline falls behind."""
+
+    def __init__(
+        self,
+        target_latency: float = TARGET_LATENCY,
+        window: int = 20,
+        min_samples: int = 5,
+        on_change: Optional[Callable[[], None]] = None,
+    ):
+        self.on_change = on_change  # called after the resolution or frame rate changes
+        self.target_latency = target_latency
+        self.min_samples = min_samples
+        self.latencies: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=window))
+        self.frame_rate_divisor = 1
+        self._resolution_index = 0
+
+    @property
+    def current_resolution(self) -> Tuple[int, int]:
+        return FRAME_RESOLUTIONS[self._resolution_index]
+
+    def record_latency(self, stage: str, latency: float) -> None:
+        """Record how long a pipeline stage (e.g. "llm", "tts") took, in seconds."""
+        self.latencies[stage].append(latency)
+        self._adapt_quality()
+
+    def _p95(self) -> float:
+        """Sum of the per-stage p95 latencies, an estimate of end-to-end p95."""
+        total = 0.0
+        for samples in self.latencies.values():
+            if not samples:
+                continue
+            ordered = sorted(samples)
+            total += ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))]
+        return total
+
+    def _adapt_quality(self) -> None:
+        if sum(len(s) for s in self.latencies.values()) < self.min_samples:
+            return
+        p95 = self._p95()
+        if p95 > self.target_latency:
+            # Shed resolution first, then frame rate
+            if self._resolution_index < len(FRAME_RESOLUTIONS) - 1:
+                self._resolution_index += 1
+            elif self.frame_rate_divisor < MAX_FRAME_RATE_DIVISOR:
+                self.frame_rate_divisor += 1
+            else:
+                return
+        elif p95 < self.target_latency / 2:
+            if self.frame_rate_divisor > 1:
+                self.frame_rate_divisor -= 1
+            elif self._resolution_index > 0:
+                self._resolution_index -= 1
+            else:
+                return
+        else:
+            return
+        # Start a fresh window so the next step is judged on samples taken at the new quality
+        for samples in self.latencies.values():
+            samples.clear()
+        logger.info(
+            "Adapted video quality (p95=%.2fs): resolution=%s, frame_rate_divisor=%d",
+            p95, self.current_resolution, self.frame_rate_divisor,
+        )
+        if self.on_change is not None:
+            self.on_change()
+
+
+# ---------------------------------------------------------------------------
+# Frame fan-out
+# ---------------------------------------------------------------------------
+
+FRAME_QUEUE_SIZE = 2
+
+
+class FrameBroker:
+    """Fan out frames from a single decoder to bounded per-subscriber queues.
+
+    A subscriber that falls behind loses its oldest queued frame rather than
+    slowing down the producer or growing without bound.
+    """
+
+    def __init__(self):
+        self._subs: List[asyncio.Queue] = []
+
+    def subscribe(self, maxsize: int = FRAME_QUEUE_SIZE) -> asyncio.Queue:
+        sub: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self._subs.append(sub)
+        return sub
+
+    def unsubscribe(self, sub: asyncio.Queue) -> None:
+        self._subs.remove(sub)
+
+    def publish(self, frame: VideoFrame) -> None:
+        for sub in self._subs:
+            try:
+                sub.put_nowait(frame)
+            except asyncio.QueueFull:
+                sub.get_nowait()
+                sub.put_nowait(frame)
+
+    @staticmethod
+    def latest(sub: asyncio.Queue, default: Optional[VideoFrame] = None) -> Optional[VideoFrame]:
+        """Drain a subscriber queue without waiting and return the newest frame, or ``default``."""
+        frame = default
+        while not sub.empty():
+            frame = sub.get_nowait()
+        return frame
+
 
 # ---------------------------------------------------------------------------
 # Main agent class
@@ -72,11 +433,31 @@ class MathTutorAgent:
         self.agent: Optional[Agent] = None
         self.agent_session: Optional[AgentSession] = None
         self._is_user_speaking: bool = False
+        self._is_agent_speaking: bool = False
+        self._tts_requested_at: Optional[float] = None  # When text was first handed to TTS, for latency
         self.room = None  # will hold the Room instance once connected
-        self.last_video_frame = None  # Last video frame processed
-        self.last_image_data = None  # Last image data from RPC
+        self.task_group: Optional[asyncio.TaskGroup] = None  # owns the agent's background tasks
+        # Optional capabilities, resolved once in start(); None when unavailable
+        self._say = None  # AgentSession.say
+        self._publish_metadata = None  # LocalParticipant.update_metadata
+        self.latency_optimizer = LatencyOptimizer(on_change=self._update_frame_period)
+        self._frame_period = 1.0 / NOT_SPEAKING_FRAME_RATE  # seconds between sampled frames
+        self._cached_image_part: Optional[llm.ImageContent] = None  # Latest canvas image, from RPC or video
+        self._image_cache: "OrderedDict[int, str]" = OrderedDict()  # Encoded canvas images by payload hash, LRU
         self.last_student_question = ""  # Last question received from student
-        self.analysis_in_progress = False  # Flag to prevent overlapping analysis
+        self._history: List[llm.ChatMessage] = []  # Recent turns, sent after the pinned system message
+        self._openai_client: Optional[openai.AsyncOpenAI] = None  # Created in start(), closed by aclose()
+        self._llm: Optional[openai_llm.LLM] = None
+        self._analysis_queue: asyncio.Queue = asyncio.Queue()
+        self._batcher_task: Optional[asyncio.Task] = None
+        self._stream_tasks: set = set()  # Reply streaming tasks, cancelled on disconnect
+        self._out_queue: List[str] = []  # Text messages waiting for the next flush
+        self._flush_task: Optional[asyncio.Task] = None
+        self._shutdown = asyncio.Event()  # Set when the room disconnects or the job is shut down
+        self._current_frame_hash: Optional[int] = None  # Hash of the latest checked frame
+        self._speculative_hash: Optional[int] = None  # Frame hash the speculative reply was made for
+        self._speculative_task: Optional[asyncio.Task] = None
+        self._stability_track_sid: Optional[str] = None  # The one video track watched for speculation
 
     # ------------------------- LiveKit lifecycle ------------------------- #
 
@@ -97,11 +478,12 @@ class MathTutorAgent:
             raise
 
         # announce ourselves as an agent so the front‑end can recognise us
-        if hasattr(ctx.room.local_participant, "update_metadata"):
-                try:
-                    await ctx.room.local_participant.update_metadata(json.dumps({"kind": "agent"}))
-                except Exception:
-                    logger.warning("Could not set participant metadata; continuing without it")
+        self._publish_metadata = getattr(ctx.room.local_participant, "update_metadata", None)
+        if self._publish_metadata is not None:
+            try:
+                await self._publish_metadata(_AGENT_METADATA)
+            except Exception:
+                logger.warning("Could not set participant metadata; continuing without it")
         self.room = ctx.room
 
         try:
@@ -116,8 +498,9 @@ class MathTutorAgent:
             self.agent = Agent(instructions=_SYSTEM_PROMPT, chat_ctx=chat_ctx)
 
             # Create a TTS model or use a DummyTTS if you don't need voice
+            self._openai_client = openai_client = _create_openai_client()
             try:
-                tts_model = openai_tts.TTS()
+                tts_model = openai_tts.TTS(client=openai_client)
                 logger.info("Using OpenAI TTS")
             except Exception as e:
                 logger.warning(f"OpenAI TTS not available: {e}, using DummyTTS")
@@ -125,11 +508,15 @@ class MathTutorAgent:
 
             # Create an agent session with LLM and TTS
             # Use the OpenAI LLM from the correct module
+            self._llm = openai_llm.LLM(model="gpt-4o", client=openai_client)
             self.agent_session = AgentSession(
-                llm=openai_llm.LLM(model="gpt-4o"),
+                llm=self._llm,
                 tts=tts_model,
                 allow_interruptions=True,
             )
+            self._say = getattr(self.agent_session, "say", None)
+            self.agent_session.on("user_state_changed", self._on_user_state_changed)
+            self.agent_session.on("agent_state_changed", self._on_agent_state_changed)
 
             # Register RPC & event handlers
             ctx.room.local_participant.register_rpc_method("analyzeImage", self._handle_image_analysis)
@@ -137,10 +524,13 @@ class MathTutorAgent:
             # Register event handlers - the correct way
             ctx.room.on("track_subscribed", self._on_track_subscribed)
             ctx.room.on("data_received", self._on_data_received)
+            ctx.room.on("disconnected", self._on_disconnected)
+            ctx.add_shutdown_callback(self._on_job_shutdown)
 
             # Start the agent session with our agent in the room
             logger.info("Starting agent session…")
             await self.agent_session.start(agent=self.agent, room=ctx.room)
+            self._batcher_task = self.task_group.create_task(self._run_analysis_batcher())
 
             # Send a greeting
             await self._send_greeting()
@@ -149,166 +539,570 @@ class MathTutorAgent:
             logger.error("Error during agent startup", exc_info=True)
             raise
 
+    async def aclose(self):
+        """Close the agent's OpenAI client and its connection pool, if one was created."""
+        if self._openai_client is not None:
+            client, self._openai_client = self._openai_client, None
+            await client.close()
+
     # ------------------------- Data helpers --------------------------- #
 
     async def _publish_text(self, text: str):
-        """Send a small JSON packet on topic='transcription' so the UI can display it."""
+        """Queue a text message for the UI; messages are flushed together after PUBLISH_FLUSH_DELAY."""
+        self._out_queue.append(text)
+        if self._flush_task is None:
+            self._flush_task = self.task_group.create_task(self._flush_soon())
+
+    async def _flush_soon(self):
+        """Publish queued text messages as one {"texts": [...]} packet on topic='transcription'.
+
+        Runs until the queue is empty, so messages queued during a publish go out
+        in the next packet and packets are never reordered by a second flush.
+        """
+        try:
+            while self._out_queue:
+                await asyncio.sleep(PUBLISH_FLUSH_DELAY)
+                texts, self._out_queue = self._out_queue, []
+
+                # Collapse consecutive duplicates
+                texts = [text for i, text in enumerate(texts) if i == 0 or text != texts[i - 1]]
+                if await self._publish_packet({"texts": texts}) and logger.isEnabledFor(logging.INFO):
+                    logger.info("Published %d text message(s): %.50s...", len(texts), texts[-1])
+        finally:
+            self._flush_task = None
+
+    async def _flush_pending(self):
+        """Wait for queued text messages to be published, e.g. before shutting down."""
+        if self._flush_task is not None:
+            await self._flush_task
+
+    async def _publish_delta(self, delta: str):
+        """Send a partial reply while it is still streaming; the full text follows via _publish_text."""
+        await self._publish_packet({"delta": delta})
+
+    async def _publish_packet(self, packet: Dict[str, Any]) -> bool:
+        """Publish a JSON packet on topic='transcription'. Returns True on success."""
         if not self.room:
-            return
+            return False
         try:
             await self.room.local_participant.publish_data(
-                json.dumps({"text": text}).encode("utf-8"), topic="transcription"
+                orjson.dumps(packet), topic="transcription"
             )
-            logger.info(f"Published text message: {text[:50]}...")
+            return True
         except Exception as e:
-            logger.error(f"Failed to publish text data: {e}")
+            logger.error("Failed to publish text data: %s", e)
+            return False
 
-    async def _generate_analysis(self, prompt: str):
-        """Generate analysis with the agent and speak/publish the response."""
-        if self.analysis_in_progress:
-            logger.info("Analysis already in progress, skipping...")
-            return
-            
+    async def _generate_analysis(self, prompt: str, silent: bool = False) -> Optional[str]:
+        """Queue a prompt for analysis and wait for its share of the batched reply.
+
+        With ``silent=True`` the prompt bypasses the batcher and the reply is only
+        returned, not published or spoken.
+        """
+        # Capture the canvas image now: a video frame may replace it before the batch is built
+        image_part = self._cached_image_part
+        if silent:
+            return await self._complete(self._build_chat_ctx(prompt, [image_part]))
+
+        future = asyncio.get_running_loop().create_future()
+        await self._analysis_queue.put((prompt, image_part, future))
+        return await future
+
+    async def _run_analysis_batcher(self):
+        """Coalesce prompts arriving within ANALYSIS_BATCH_TIMEOUT into one LLM call."""
+        while True:
+            batch = [await self._analysis_queue.get()]
+            deadline = time.monotonic() + ANALYSIS_BATCH_TIMEOUT
+            while len(batch) < ANALYSIS_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._analysis_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._analyze_batch(batch)
+            except Exception:
+                logger.error("Unexpected error in analysis batch", exc_info=True)
+                await self._publish_text(_ANALYSIS_FALLBACK_TEXT)
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_result(None)
+
+    async def _analyze_batch(self, batch: List[Tuple[str, Optional[llm.ImageContent], asyncio.Future]]):
+        """Answer a batch of prompts with one LLM call, then speak/publish the response."""
+        prompts = [prompt for prompt, _, _ in batch]
         try:
-            self.analysis_in_progress = True
-            logger.info(f"Generating analysis for prompt: {prompt[:50]}...")
-            
-            # Generate a response
-            reply = await self.agent_session.generate_reply(user_input=prompt)
-            
-            # Extract the text content
-            if hasattr(reply, 'content'):
-                reply_text = " ".join(reply.content) if isinstance(reply.content, list) else str(reply.content)
+            if len(prompts) == 1:
+                user_input = prompts[0]
             else:
-                reply_text = str(reply)
-                
-            # Publish the text to the frontend
-            await self._publish_text(reply_text)
-            
-            # Speak the response
-            if self.agent_session and hasattr(self.agent_session, 'say'):
-                self.agent_session.say(reply_text)
-            
-            logger.info(f"Generated and published analysis: {reply_text[:50]}...")
-            return reply_text
-        except Exception as e:
-            logger.error(f"Error generating analysis: {e}", exc_info=True)
-            await self._publish_text(f"I'm having trouble analyzing your work. Please try again.")
-            return None
+                numbered = "\n".join(f"{i}. {prompt}" for i, prompt in enumerate(prompts, 1))
+                user_input = (
+                    "The student sent several messages in quick succession. Answer each numbered item "
+                    "in order, separating the answers with a line containing only ---.\n\n" + numbered
+                )
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Generating analysis for %d prompt(s): %.50s...", len(prompts), user_input)
+
+            chat_ctx = self._build_chat_ctx(user_input, [image_part for _, image_part, _ in batch])
+
+            # Stream the response to the frontend and TTS as it is generated
+            reply_text = await self._stream_reply(chat_ctx)
+
+            answers = [answer.strip() for answer in reply_text.split(_ANSWER_DELIMITER)]
+            if len(answers) != len(prompts):
+                answers = [reply_text.strip()] * len(prompts)
+            full_text = "\n\n".join(dict.fromkeys(answers))
+
+            # Publish the complete text once streaming has finished
+            await self._publish_text(full_text)
+
+            self._remember_turn(user_input, full_text)
+
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Generated and published analysis: %.50s...", full_text)
+            for (_, _, future), answer in zip(batch, answers):
+                if not future.done():
+                    future.set_result(answer)
+        except _LLM_ERRORS as e:
+            logger.error("Error generating analysis: %s", e, exc_info=False)
+            await self._publish_text(_ANALYSIS_FALLBACK_TEXT)
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+        except asyncio.CancelledError:
+            for _, _, future in batch:
+                future.cancel()
+            raise
+
+    def _set_canvas_image(self, image_base64: str):
+        """Build the LLM content part for the latest canvas image once, for reuse by every request."""
+        self._cached_image_part = llm.ImageContent(
+            image=f"data:image/jpeg;base64,{image_base64}", inference_detail="low"
+        )
+
+    def _build_chat_ctx(
+        self, user_input: str, image_parts: List[Optional[llm.ImageContent]]
+    ) -> llm.ChatContext:
+        """Chat context with the pinned system message, recent history, and the user input plus its canvas images.
+
+        ``image_parts`` are the images captured when each prompt was queued;
+        duplicates and None are dropped.
+        """
+        content: List[Any] = [user_input]
+        content.extend({id(part): part for part in image_parts if part is not None}.values())
+        chat_ctx = llm.ChatContext([_SYSTEM_MESSAGE, *self._history])
+        chat_ctx.add_message(role="user", content=content)
+        return chat_ctx
+
+    def _remember_turn(self, user_input: str, reply: str):
+        """Append a completed exchange to the history, dropping the oldest messages past MAX_HISTORY_MESSAGES.
+
+        Only the text is kept; the canvas image is attached to the newest user message alone.
+        """
+        self._history.append(llm.ChatMessage(role="user", content=[user_input]))
+        self._history.append(llm.ChatMessage(role="assistant", content=[reply]))
+        del self._history[:-MAX_HISTORY_MESSAGES]
+
+    async def _stream_reply(self, chat_ctx: llm.ChatContext) -> str:
+        """Stream the LLM reply into TTS and the data channel concurrently; return the raw reply text."""
+        publish_queue: asyncio.Queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        tts_queue: asyncio.Queue = asyncio.Queue()
+        speech = None
+        if self._say is not None:
+            speech = self._say(self._iter_queue(tts_queue))
+
+        parts: List[str] = []
+
+        async def emit(piece: Optional[str]):
+            await publish_queue.put(piece)
+            # Never block on TTS: queued speech may not start for a while, or ever if interrupted
+            if speech is not None and not speech.interrupted:
+                if piece and self._tts_requested_at is None and not self._is_agent_speaking:
+                    self._tts_requested_at = time.monotonic()
+                tts_queue.put_nowait(piece)
+
+        async def produce():
+            started = time.monotonic()
+            pending = ""
+            usage = None
+            try:
+                async with self._llm.chat(chat_ctx=chat_ctx) as stream:
+                    async for chunk in stream:
+                        if chunk.usage is not None:
+                            usage = chunk.usage
+                        if not (chunk.delta and chunk.delta.content):
+                            continue
+                        if not parts:
+                            self.latency_optimizer.record_latency("llm", time.monotonic() - started)
+                        parts.append(chunk.delta.content)
+
+                        # Hide answer delimiters, holding back a tail that may be a partial one
+                        pending = (pending + chunk.delta.content).replace(_ANSWER_DELIMITER, "\n\n")
+                        safe = len(pending) - (len(_ANSWER_DELIMITER) - 1)
+                        if safe > 0:
+                            await emit(pending[:safe])
+                            pending = pending[safe:]
+                if pending:
+                    await emit(pending)
+                if usage is not None:
+                    logger.info(
+                        "LLM usage: %d prompt tokens (%d cached), %d completion tokens",
+                        usage.prompt_tokens, usage.prompt_cached_tokens, usage.completion_tokens,
+                    )
+            finally:
+                await emit(None)
+
+        tasks = [
+            asyncio.create_task(produce()),
+            asyncio.create_task(self._pump_published_deltas(publish_queue)),
+        ]
+        self._stream_tasks.update(tasks)
+        try:
+            await asyncio.gather(*tasks)
         finally:
-            self.analysis_in_progress = False
+            self._stream_tasks.difference_update(tasks)
+            for task in tasks:
+                task.cancel()
+        return "".join(parts)
+
+    async def _pump_published_deltas(self, pieces: asyncio.Queue):
+        """Publish streamed tokens in chunks of about STREAM_PUBLISH_CHUNK_CHARS characters."""
+        buffer = ""
+        while (piece := await pieces.get()) is not None:
+            buffer += piece
+            if len(buffer) >= STREAM_PUBLISH_CHUNK_CHARS:
+                await self._publish_delta(buffer)
+                buffer = ""
+        if buffer:
+            await self._publish_delta(buffer)
+
+    async def _complete(self, chat_ctx: llm.ChatContext) -> str:
+        """Run a chat completion and return the full reply text."""
+        parts: List[str] = []
+        async with self._llm.chat(chat_ctx=chat_ctx) as stream:
+            async for chunk in stream:
+                if chunk.delta and chunk.delta.content:
+                    parts.append(chunk.delta.content)
+        return "".join(parts)
+
+    @staticmethod
+    async def _iter_queue(items: asyncio.Queue):
+        """Yield items from a queue until the None sentinel."""
+        while (item := await items.get()) is not None:
+            yield item
 
     # ------------------------- Event handlers --------------------------- #
 
     def _on_track_subscribed(self, track: Track, publication, participant):
         """Handle track subscribed event with correct signature."""
         if track.kind == TrackKind.KIND_VIDEO:
-            asyncio.create_task(self._handle_video_track(track))
+            self.task_group.create_task(self._run_guarded(self._handle_video_track(track), "video track handler"))
         elif track.kind == TrackKind.KIND_AUDIO:
             # Process audio track - LiveKit handles this automatically for voice chat
             logger.info(f"Received audio track: {track.sid}")
 
+    def _on_user_state_changed(self, event):
+        """Sample video faster while the student is speaking."""
+        self._is_user_speaking = event.new_state == "speaking"
+        self._update_frame_period()
+
+    def _on_agent_state_changed(self, event):
+        """Record TTS latency: first text handed to TTS until the agent starts speaking."""
+        self._is_agent_speaking = event.new_state == "speaking"
+        if self._is_agent_speaking and self._tts_requested_at is not None:
+            self.latency_optimizer.record_latency("tts", time.monotonic() - self._tts_requested_at)
+            self._tts_requested_at = None
+
+    def _on_disconnected(self, *args):
+        """Stop any in-flight reply streaming when the room goes away."""
+        self._shutdown.set()
+        if self._batcher_task:
+            self._batcher_task.cancel()
+        for task in list(self._stream_tasks):
+            task.cancel()
+
+    async def _on_job_shutdown(self):
+        """Stop waiting when the worker shuts the job down."""
+        self._shutdown.set()
+
     def _on_data_received(self, data, participant, topic):
         """Handle data received event with correct signature."""
         # Only process data on the transcription topic - this is for user speech
         if topic == "transcription":
-            asyncio.create_task(self._handle_data_received(data, participant, topic))
+            self.task_group.create_task(
+                self._run_guarded(self._handle_data_received(data, participant, topic), "transcription handler")
+            )
+
+    @staticmethod
+    async def _run_guarded(coro, description: str):
+        """Run a background handler, logging unexpected errors instead of tearing down the task group."""
+        try:
+            await coro
+        except Exception:
+            logger.error("Unexpected error in %s", description, exc_info=True)
 
     async def _handle_video_track(self, track: Track):
-        """Handle video track from screen share."""
+        """Handle video track from screen share.
+
+        This is the track's only decoder: frames are fanned out through a
+        FrameBroker to the sampler and, for the first video track only, the
+        stability watcher; each only looks at the newest frame when it wakes up.
+        """
         logger.info(f"Received video track: {track.sid}")
-        video_stream = VideoStream(track)
-        last_frame_time = 0.0
-        frame_counter = 0
-        
+        video_stream = VideoStream(track, capacity=1)
+        broker = FrameBroker()
+        sampler_frames = broker.subscribe()
+        sampler = asyncio.create_task(
+            self._run_guarded(self._sample_video_frames(sampler_frames), "video frame sampler")
+        )
+        stability_frames = stability_watcher = None
+        if self._stability_track_sid is None:
+            # Speculation state is shared, so only the first video track is watched
+            self._stability_track_sid = track.sid
+            stability_frames = broker.subscribe()
+            stability_watcher = asyncio.create_task(
+                self._run_guarded(self._watch_frame_stability(stability_frames), "frame stability watcher")
+            )
+
         try:
-            async for frame in video_stream:
-                now = asyncio.get_event_loop().time()
-                if now - last_frame_time < self._frame_interval():
-                    continue
-                last_frame_time = now
-                frame_counter += 1
-                self.last_video_frame = frame
-
-                # Every 30th frame, generate a response about the work
-                if frame_counter % 30 == 0 and not self.analysis_in_progress:
-                    logger.info(f"Processing video frame {frame_counter}")
-                    
-                    # Extract image from frame if needed
-                    # This depends on what you want to do with the video frames
-                    
-                    # Only analyze if there's a recent student question or it's been a while
-                    if self.last_student_question or frame_counter % 120 == 0:
-                        prompt = self.last_student_question or "Please analyze what you see on my canvas."
-                        self.last_student_question = ""  # Clear after using
-                        await self._generate_analysis(prompt)
-                        
-        except Exception as e:
-            logger.error(f"Error handling video stream: {e}", exc_info=True)
+            async for event in video_stream:
+                broker.publish(event.frame)
         finally:
+            sampler.cancel()
+            broker.unsubscribe(sampler_frames)
+            if stability_watcher is not None:
+                stability_watcher.cancel()
+                broker.unsubscribe(stability_frames)
+                self._stability_track_sid = None
+                self._current_frame_hash = None  # The speculative reply no longer matches any canvas
             await video_stream.aclose()
             logger.info("Video stream closed")
 
+    async def _sample_video_frames(self, frames: asyncio.Queue):
+        """Pick up the latest video frame every ``_frame_period`` seconds."""
+        frame_counter = 0
+        frame = None
+
+        while True:
+            await asyncio.sleep(self._frame_period)
+            frame = FrameBroker.latest(frames, frame)
+            if frame is None:
+                continue
+            frame_counter += 1
+
+            # Every 30th frame, generate a response about the work
+            if frame_counter % 30 == 0:
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info("Processing video frame %d", frame_counter)
+
+                # Only analyze if there's a recent student question or it's been a while
+                if self.last_student_question or frame_counter % 120 == 0:
+                    try:
+                        self._set_canvas_image(await self._process_image(frame))
+                    except _IMAGE_ERRORS as e:
+                        logger.error("Error converting video frame: %s", e, exc_info=False)
+                        continue
+                    prompt = self.last_student_question or "Please analyze what you see on my canvas."
+                    self.last_student_question = ""  # Clear after using
+                    await self._generate_analysis(prompt)
+
+    async def _watch_frame_stability(self, frames: asyncio.Queue):
+        """Start a speculative analysis once the frame has been stable for STABLE_FRAME_COUNT checks."""
+        last_hash = None
+        stable_count = 0
+        frame = None
+        # Per watcher, since watchers for different tracks hash in parallel threads
+        blocks = np.empty((_SIGNATURE_GRID, _SIGNATURE_GRID), dtype=np.float64)
+
+        while True:
+            await asyncio.sleep(STABILITY_CHECK_INTERVAL)
+            frame = FrameBroker.latest(frames, frame)
+            if frame is None:
+                continue
+
+            try:
+                frame_hash = await asyncio.to_thread(self._frame_hash, frame, blocks)
+            except _IMAGE_ERRORS as e:
+                logger.error("Error hashing video frame: %s", e, exc_info=False)
+                continue
+            if frame_hash == last_hash:
+                stable_count += 1
+            else:
+                last_hash = frame_hash
+                stable_count = 1
+            self._current_frame_hash = frame_hash
+
+            if stable_count == STABLE_FRAME_COUNT and frame_hash != self._speculative_hash:
+                if self._speculative_task and not self._speculative_task.done():
+                    self._speculative_task.cancel()
+                try:
+                    self._set_canvas_image(await self._process_image(frame))
+                except _IMAGE_ERRORS as e:
+                    logger.error("Error converting video frame: %s", e, exc_info=False)
+                    continue
+                logger.info("Canvas is stable, starting speculative analysis")
+                self._speculative_hash = frame_hash
+                self._speculative_task = self.task_group.create_task(self._speculate())
+
+    async def _speculate(self) -> Optional[str]:
+        """Run a speculative analysis, logging failures instead of tearing down the task group."""
+        try:
+            return await self._generate_analysis(SPECULATIVE_PROMPT, silent=True)
+        except Exception as e:
+            logger.warning("Speculative analysis failed: %s", e)
+            return None
+
+    def _take_speculative_reply(self) -> Optional[str]:
+        """Return the speculative reply if it is ready and the canvas hasn't changed since."""
+        task = self._speculative_task
+        if task is None or not task.done() or task.cancelled() or task.exception() is not None:
+            return None
+        if self._speculative_hash != self._current_frame_hash:
+            return None
+        self._speculative_task = None
+        return task.result()
+
     async def _handle_data_received(self, payload, participant, topic):
         """Handle data packets received on the transcription topic."""
         if topic != "transcription":
             return
             
         try:
-            message = json.loads(payload.decode("utf-8"))
-            if "text" in message:
-                text = message["text"]
-                logger.info(f"Received transcription: {text}")
-                
-                # Set as the latest question
-                self.last_student_question = text
-                
-                # Generate a response
-                await self._generate_analysis(text)
-                
-        except Exception as e:
-            logger.error(f"Error processing transcription: {e}", exc_info=True)
+            text = TranscriptionMsg.model_validate_json(payload).text
+        except ValidationError as e:
+            error = e.errors()[0]
+            if error["type"] == "missing" and error["loc"] == ("text",):
+                logger.debug("Ignoring transcription packet without text")
+            else:
+                logger.error("Error processing transcription: %s", error["msg"])
+            return
+
+        if text:
+            logger.info("Received transcription: %s", text)
+            
+            # Set as the latest question
+            self.last_student_question = text
+
+            cached_reply = self._take_speculative_reply()
+            if cached_reply and _GENERIC_CHECK_RE.match(text.strip()):
+                # The current canvas was already analyzed and that is all the student asked for
+                logger.info("Using speculative analysis for transcription")
+                self._remember_turn(text, cached_reply)
+                await self._publish_text(cached_reply)
+                if self._say is not None:
+                    self._say(cached_reply)
+                return
+
+            if cached_reply:
+                # A specific question: answer it, with the earlier analysis as context
+                text = f"{text}\n\n(Your earlier analysis of the current canvas, for reference: {cached_reply})"
+
+            # Generate a response
+            await self._generate_analysis(text)
 
     async def _handle_image_analysis(self, request_data: str) -> str:
         """Handle image analysis RPC call from frontend."""
         try:
-            data = json.loads(request_data)
-            if "imageData" not in data:
-                return json.dumps({"error": "No image data provided"})
-                
-            image_data = data["imageData"]
-            self.last_image_data = image_data
-            
-            # Only process if we haven't recently analyzed an image
-            if not self.analysis_in_progress:
-                # Convert the image data to an actual image if needed
-                # image_base64 = image_data.split(',')[1] if ',' in image_data else image_data
-                # self._process_image(image_base64)
-                
-                # Generate analysis with current context from the student's canvas
-                prompt = self.last_student_question or "Please analyze what I've written on the canvas."
-                self.last_student_question = ""  # Clear after using
-                
-                await self._generate_analysis(prompt)
-                
-            return json.dumps({"status": "success", "message": "Image analysis complete"})
-        except Exception as e:
-            logger.error(f"Image analysis failed: {e}", exc_info=True)
-            return json.dumps({"error": str(e)})
+            request = AnalyzeImageRequest.model_validate_json(request_data)
+        except ValidationError as e:
+            if any(error["type"] == "missing" and error["loc"] == ("imageData",) for error in e.errors()):
+                return _NO_IMAGE_RESPONSE
+            message = e.errors()[0]["msg"]
+            logger.error("Image analysis failed: %s", message)
+            return AnalyzeImageResponse(error=message).to_json()
 
-    def _process_image(self, image_base64: str) -> None:
-        """Process an image from base64 string (optional)."""
         try:
-            # Convert base64 to image
-            image_data = base64.b64decode(image_base64)
-            image = Image.open(BytesIO(image_data))
-            
-            # Here you could perform additional image processing
-            # For example, OCR to extract text from the image
-            
-            logger.info(f"Processed image of size: {image.size}")
+            self._set_canvas_image(await self._process_image(request.imageData))
+
+            # Generate analysis with current context from the student's canvas; if an
+            # analysis is already running, the batcher answers this one right after it
+            prompt = (
+                request.prompt
+                or self.last_student_question
+                or "Please analyze what I've written on the canvas."
+            )
+            self.last_student_question = ""  # Clear after using
+
+            await self._generate_analysis(prompt)
+
+            return _IMAGE_SUCCESS_RESPONSE
+        except _IMAGE_ERRORS as e:
+            logger.error("Image analysis failed: %s", e, exc_info=False)
+            return AnalyzeImageResponse(error=str(e)).to_json()
         except Exception as e:
-            logger.error(f"Error processing image: {e}")
+            # RPC boundary: the caller always gets a JSON reply
+            logger.error("Image analysis failed unexpectedly: %s", e, exc_info=True)
+            return AnalyzeImageResponse(error=str(e)).to_json()
+
+    async def _process_image(self, source: Union[str, VideoFrame]) -> str:
+        """Prepare a canvas image (base64 string or video frame) for the vision LLM.
+
+        Decoding, downscaling and JPEG encoding all run in one worker thread hop
+        so multi-megabyte images never stall the event loop. Results for the last
+        IMAGE_CACHE_SIZE base64 images are cached, so resending the same canvas
+        skips all image work.
+        """
+        if not isinstance(source, str):
+            return await asyncio.to_thread(lambda: self._encode_image(self._frame_to_image(source)))
+
+        image_base64 = source.split(',', 1)[1] if ',' in source else source
+        key = _image_key(image_base64.encode("ascii"))
+        encoded = self._image_cache.get(key)
+        if encoded is not None:
+            self._image_cache.move_to_end(key)
+            return encoded
+
+        encoded = await asyncio.to_thread(lambda: self._encode_image(self._decode_image(image_base64)))
+        self._image_cache[key] = encoded
+        if len(self._image_cache) > IMAGE_CACHE_SIZE:
+            self._image_cache.popitem(last=False)
+        return encoded
+
+    @staticmethod
+    def _decode_image(image_base64: str) -> Image.Image:
+        """Decode a base64 image (without its ``data:`` URL prefix)."""
+        return Image.open(BytesIO(base64.b64decode(image_base64)))
+
+    @staticmethod
+    def _encode_image(image: Image.Image) -> str:
+        """Downscale an image to MAX_IMAGE_SIDE and re-encode it as base64 JPEG for the vision LLM."""
+        image.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.LANCZOS)
+        if image.mode in ("RGBA", "LA", "P"):
+            # Canvas snapshots are usually transparent; flatten onto white so strokes stay visible
+            rgba = image.convert("RGBA")
+            image = Image.new("RGB", rgba.size, (255, 255, 255))
+            image.paste(rgba, mask=rgba.getchannel("A"))
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        buffer = BytesIO()
+        image.save(buffer, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Processed image of size: %s, %d bytes", image.size, buffer.tell())
+        return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+    @staticmethod
+    def _frame_to_rgb(frame: VideoFrame) -> VideoFrame:
+        """Convert a video frame to RGB24, raising ValueError for unsupported buffer types."""
+        try:
+            return frame.convert(VideoBufferType.RGB24)
+        except Exception as e:  # VideoFrame.convert raises a bare Exception
+            raise ValueError(f"Cannot convert video frame: {e}") from e
+
+    def _frame_to_image(self, frame: VideoFrame) -> Image.Image:
+        """Convert a video frame to an RGB image, downscaled to the current resolution."""
+        rgb = self._frame_to_rgb(frame)
+        image = Image.frombytes("RGB", (rgb.width, rgb.height), bytes(rgb.data))
+        image.thumbnail(self.latency_optimizer.current_resolution)
+        return image
+
+    @staticmethod
+    def _frame_hash(frame: VideoFrame, blocks: np.ndarray) -> int:
+        """64-bit perceptual signature of a frame, see ``_frame_signature``; ``blocks`` is the caller's scratch buffer."""
+        rgb = MathTutorAgent._frame_to_rgb(frame)
+        pixels = np.frombuffer(rgb.data, dtype=np.uint8).reshape(rgb.height, rgb.width, 3)
+        return int(_frame_signature(pixels, blocks))
 
     # ------------------------- Helpers --------------------------- #
 
@@ -323,12 +1117,13 @@ class MathTutorAgent:
         await self._publish_text(greeting)
         
         # Speak the greeting
-        if self.agent_session and hasattr(self.agent_session, 'say'):
-            self.agent_session.say(greeting)
+        if self._say is not None:
+            self._say(greeting)
 
-    def _frame_interval(self) -> float:
-        """Calculate frame interval based on speaking state."""
-        return 1.0 / (SPEAKING_FRAME_RATE if self._is_user_speaking else NOT_SPEAKING_FRAME_RATE)
+    def _update_frame_period(self):
+        """Recompute the frame sampling period from speaking state and current video quality."""
+        frame_rate = SPEAKING_FRAME_RATE if self._is_user_speaking else NOT_SPEAKING_FRAME_RATE
+        self._frame_period = self.latency_optimizer.frame_rate_divisor / frame_rate
 
 
 # ---------------------------------------------------------------------------
@@ -338,17 +1133,39 @@ class MathTutorAgent:
 
 async def entrypoint(ctx: JobContext):
     """Main entrypoint for the LiveKit worker."""
+    startup_error: Optional[BaseException] = None
+    stopping = False
+    agent = MathTutorAgent()
     try:
-        agent = MathTutorAgent()
-        await agent.start(ctx)
-        
-        # Keep agent running
-        while True:
-            await asyncio.sleep(60)
-            logger.info("Agent heartbeat – still running")
+        async with asyncio.TaskGroup() as task_group:
+            agent.task_group = task_group
+            try:
+                await agent.start(ctx)
+            except Exception as e:
+                # Re-raised below so it is not wrapped in an ExceptionGroup
+                startup_error = e
+            else:
+                # Keep agent running until the room disconnects or the job is shut down
+                await agent._shutdown.wait()
+                await agent._flush_pending()
+
+            # Cancel the group's background tasks
+            stopping = True
+            raise asyncio.CancelledError("Agent shutting down")
+    except asyncio.CancelledError:
+        if not stopping:
+            raise
+        if startup_error is None:
+            logger.info("Agent shut down")
     except Exception as e:
         logger.error(f"Agent error: {e}", exc_info=True)
         raise
+    finally:
+        await agent.aclose()
+
+    if startup_error is not None:
+        logger.error(f"Agent error: {startup_error}", exc_info=startup_error)
+        raise startup_error
 
 
 if __name__ == "__main__":